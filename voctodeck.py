@@ -11,39 +11,87 @@
 # tiles generated at runtime, and responding to button state change events.
 
 import os
+import contextlib
+import functools
+import logging
 import time
-import threading
-from subprocess import Popen, call, check_output
+import selectors
+from subprocess import Popen, CalledProcessError, check_output
+import alsaaudio
+import dbus
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 from StreamDeck.DeviceManager import DeviceManager
 from StreamDeck.ImageHelpers import PILHelper
 
 import socket
+import struct
 import json
 
+log = logging.getLogger(__name__)
+
 s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 s.connect(('localhost', 9999))
+s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 s.sendall(b'get_composite_mode_and_video_status\nget_stream_status\nget_audio\n')
 
+# Commands sent within batch_sends() are collected and written with a single
+# sendall when the block exits.
+_send_buffer = None
+
+def send_cmd(cmd):
+    if _send_buffer is None:
+        s.sendall(cmd)
+    else:
+        _send_buffer.extend(cmd)
+
+@contextlib.contextmanager
+def batch_sends():
+    global _send_buffer
+    _send_buffer = bytearray()
+    try:
+        yield
+    finally:
+        buffer, _send_buffer = _send_buffer, None
+        if buffer:
+            s.sendall(buffer)
+
+# Background images per deck and color to copy instead of allocating and
+# filling a new image for every render.
+_BACKGROUNDS = {}
+
+# Loaded once, ImageDraw would otherwise load the default font for every Draw.
+FONT = ImageFont.load_default()
+
+# Scratch drawing context only used to measure labels
+_MEASURE = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+
+# Returns the position that centers label on an image of the given size.
+@functools.lru_cache(maxsize=None)
+def label_position(label, size):
+    _, _, label_w, label_h = _MEASURE.multiline_textbbox((0, 0), label, font=FONT)
+    return ((size[0] - label_w) // 2, (size[1] - label_h) // 2)
+
 # Generates a custom tile with run-time generated text and custom image via the
 # PIL module.
-def render_key_image(deck, btn):
-    # Create new key image of the correct dimensions, black background
-    image = PILHelper.create_image(deck)
+def render_key_image(deck, btn, selected):
+    # Create new key image of the correct dimensions, filled with the selected
+    # color or black
+    color = btn.selected_color if selected else "black"
+    background = _BACKGROUNDS.get((deck.id(), color))
+    if background is None:
+        background = _BACKGROUNDS[deck.id(), color] = PILHelper.create_image(deck, background=color)
+    image = background.copy()
     draw = ImageDraw.Draw(image)
 
-    if btn.selected:
-        draw.rectangle((0, 0, image.width - 1, image.height - 1), fill=btn.selected_color)
-
-    label_w, label_h = draw.textsize(btn.label)
-    label_pos = ((image.width - label_w) // 2, (image.height - label_h) // 2)
-    draw.text(label_pos, text=btn.label, fill="white")
+    draw.text(label_position(btn.label, image.size), text=btn.label, font=FONT, fill="white")
 
     return PILHelper.to_native_format(deck, image)
 
 
 class Button(object):
     selected = False
+    selected_color = "black"
 
     def __init__(self, label=""):
         self.label = label
@@ -59,11 +107,11 @@ class SceneButton(Button):
 
     def __init__(self, label, layout, inputs):
         Button.__init__(self, label)
-        self.scene = (' '.join(inputs) + ' ' + layout).encode('utf-8')
+        self.command = f'set_videos_and_composite {" ".join(inputs)} {layout}\n'.encode('utf-8')
         SCENE_BUTTONS[tuple([layout] + inputs)] = self
 
     def pressed(self):
-        s.sendall(b'set_videos_and_composite ' + self.scene + b'\n')
+        send_cmd(self.command)
 
 AUDIO_BUTTONS = []
 
@@ -74,10 +122,16 @@ class AudioButton(Button):
     def __init__(self, label, channel):
         Button.__init__(self, label)
         self.channel = channel
+        self.command = f'set_audio {channel}\n'.encode('utf-8')
+        self.index = len(AUDIO_BUTTONS)
         AUDIO_BUTTONS.append(self)
 
+    @property
+    def selected(self):
+        return bool(AUDIO_STATE[self.index])
+
     def pressed(self):
-        s.sendall(f'set_audio {self.channel}\n'.encode('utf-8'))
+        send_cmd(self.command)
 
 
 STREAM_BUTTONS = {}
@@ -87,12 +141,11 @@ class StreamButton(Button):
 
     def __init__(self, label, state, blank):
         Button.__init__(self, label)
-        self.state = state.encode('utf-8')
-        self.blank = blank
+        self.command = (f'set_stream_blank {state}\n' if blank else 'set_stream_live\n').encode('utf-8')
         STREAM_BUTTONS[state, blank] = self
 
     def pressed(self):
-        s.sendall(((b'set_stream_blank ' + self.state) if self.blank else b'set_stream_live') + b'\n')
+        send_cmd(self.command)
 
 
 class ExecButton(Button):
@@ -111,10 +164,60 @@ class I3workspaceButton(Button):
     def __init__(self, label, workspace):
         Button.__init__(self, label)
         self.workspace = workspace
+        self.cmd = ['i3-msg', 'workspace', str(workspace)]
         I3BUTTONS[workspace] = self
 
     def pressed(self):
-        Popen(['i3-msg', 'workspace', str(self.workspace)])
+        Popen(self.cmd)
+
+# The checks run on the event loop thread, so D-Bus calls must not block it
+# for long (dbus-python waits about 25 seconds by default).
+DBUS_TIMEOUT = 0.5
+
+# Returns a check for whether a systemd user unit is active, asking systemd
+# over D-Bus instead of running systemctl. The unit is looked up on first use
+# and the check is False while the session bus or the unit is unavailable.
+def systemd_unit_active(name):
+    unit = None
+
+    def check():
+        nonlocal unit
+        try:
+            if unit is None:
+                bus = dbus.SessionBus()
+                systemd = bus.get_object('org.freedesktop.systemd1', '/org/freedesktop/systemd1',
+                        introspect=False)
+                unit = bus.get_object('org.freedesktop.systemd1',
+                        systemd.LoadUnit(name, dbus_interface='org.freedesktop.systemd1.Manager',
+                            timeout=DBUS_TIMEOUT),
+                        introspect=False)
+            return unit.Get('org.freedesktop.systemd1.Unit', 'ActiveState',
+                    dbus_interface=dbus.PROPERTIES_IFACE, timeout=DBUS_TIMEOUT) == 'active'
+        except dbus.DBusException:
+            return False
+    return check
+
+
+# Returns a check for whether an ALSA mixer control has its capture volume at
+# zero, reading the mixer directly instead of running amixer. The mixer is
+# opened on first use and the check is False while the control is unavailable.
+def alsa_capture_muted(control):
+    mixer = None
+
+    def check():
+        nonlocal mixer
+        try:
+            if mixer is None:
+                mixer = alsaaudio.Mixer(control)
+            # alsa-lib only refreshes cached values when pending events are
+            # handled, without this changes made by micmute.sh go unnoticed
+            mixer.handleevents()
+            # Like grep on amixer's output, muted if any channel is at zero
+            return 0 in mixer.getvolume(alsaaudio.PCM_CAPTURE, alsaaudio.VOLUME_UNITS_RAW)
+        except alsaaudio.ALSAAudioError:
+            return False
+    return check
+
 
 UPDATE_BUTTONS = []
 
@@ -138,133 +241,227 @@ BUTTONS = [
         AudioButton("CAM\nAUDIO", "cam"),
         SceneButton("Side-by-\nside\npreview", "side_by_side_preview", ["slides", "cam"]),
         StreamButton("STREAM\nPAUSE", "pause", blank=True),
-        ExecUpdateButton('YK', 'systemctl --user restart yubikey-agent', 'systemctl --user status yubikey-agent >/dev/null'),
+        ExecUpdateButton('YK', 'systemctl --user restart yubikey-agent', systemd_unit_active('yubikey-agent.service')),
 
         Button("PC\nRESTART"),
         Button("CAM\nRESTART"),
         SceneButton("Side-by-\nside\nequal", "side_by_side_equal", ["slides", "cam"]), 
         StreamButton("NO\nSTREAM", "nostream", blank=True),
-        ExecUpdateButton('MIC\nMUTE', './micmute.sh', 'amixer get Digital | grep -Fq "Capture 0 ["'),
+        ExecUpdateButton('MIC\nMUTE', './micmute.sh', alsa_capture_muted('Digital')),
         ]
 
-    # Creates a new key image based on the key index, style and current key state
-# and updates the image on the StreamDeck.
-def update_key_image(deck, key):
-    # Generate the custom key with the requested image and label
-    image = render_key_image(deck, BUTTONS[key])
+# Whether each audio channel is selected, indexed like AUDIO_BUTTONS, so
+# audio_status can be applied without visiting every button.
+AUDIO_STATE = np.zeros(len(AUDIO_BUTTONS), dtype=bool)
+AUDIO_CHANNELS = {btn.channel: btn.index for btn in AUDIO_BUTTONS}
 
-    # Update requested key with the generated image
-    deck.set_key_image(key, image)
+# Labels never change, so every key only ever shows one of two images. Returns
+# the (unselected, selected) images of each key.
+def render_all_key_images(deck):
+    return [(render_key_image(deck, btn, False), render_key_image(deck, btn, True)) for btn in BUTTONS]
 
 
-# Prints key state change information, updates rhe key image and performs any
-# associated actions when a key is pressed.
+# Redraws the keys whose selection state differs from what was last drawn,
+# shown holds the state each key was drawn with.
+def repaint_changed_keys(deck, key_images, shown):
+    for key, btn in enumerate(BUTTONS):
+        selected = btn.selected
+        if selected != shown[key]:
+            shown[key] = selected
+            deck.set_key_image(key, key_images[key][selected])
+
+
+# Logs key state change information and performs any associated actions when
+# a key is pressed.
 def key_change_callback(deck, key, state):
-    # Print new key state
-    print("Deck {} Key {} = {}".format(deck.id(), key, state), flush=True)
+    log.debug("Deck %s Key %s = %s", deck.id(), key, state)
 
     if state:
-        BUTTONS[key].pressed()
-        
-
-class TickThread(threading.Thread):
-    def __init__(self, deck):
-        threading.Thread.__init__(self)
-        self.deck = deck
+        with batch_sends():
+            BUTTONS[key].pressed()
+
+
+# The connections below are served from a single selector loop in run(), each
+# registers its sockets with a callback to invoke when they become readable
+# and unregisters them once the peer closes the connection.
+
+# i3 IPC framing, see https://i3wm.org/docs/ipc.html
+I3_MAGIC = b'i3-ipc'
+I3_HEADER = struct.Struct('=6sII')
+I3_GET_WORKSPACES = 1
+I3_SUBSCRIBE = 2
+I3_EVENT = 1 << 31
+
+def i3_send(sock, msg_type, payload=b''):
+    sock.sendall(I3_HEADER.pack(I3_MAGIC, len(payload), msg_type) + payload)
+
+
+class I3Connection(object):
+    def __init__(self, sel):
+        self.sel = sel
+        path = os.environ.get('I3SOCK') or check_output(['i3', '--get-socketpath']).decode('utf-8').strip()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path)
+        except OSError:
+            self.sock.close()
+            raise
+        self.pending = bytearray()
+        # Workspace visibility only changes on workspace or output events, so
+        # fetch the workspace list initially and after each of those.
+        i3_send(self.sock, I3_SUBSCRIBE, b'["workspace", "output"]')
+        i3_send(self.sock, I3_GET_WORKSPACES)
+        sel.register(self.sock, selectors.EVENT_READ, self.readable)
+
+    def readable(self):
+        received = self.sock.recv(4096)
+        if not received:
+            self.sel.unregister(self.sock)
+            self.sock.close()
+            return
+        self.pending += received
+        while len(self.pending) >= I3_HEADER.size:
+            _, length, msg_type = I3_HEADER.unpack_from(self.pending)
+            end = I3_HEADER.size + length
+            if len(self.pending) < end:
+                break
+            payload = bytes(self.pending[I3_HEADER.size:end])
+            del self.pending[:end]
+            if msg_type & I3_EVENT:
+                i3_send(self.sock, I3_GET_WORKSPACES)
+            elif msg_type == I3_GET_WORKSPACES:
+                for workspace in json.loads(payload):
+                    btn = I3BUTTONS.get(workspace['num'])
+                    if btn:
+                        btn.selected = workspace['visible']
 
-    def run(self):
-        while True:
-            needs_update = False
-            for btn in UPDATE_BUTTONS:
-                old = btn.selected
-                btn.selected = call(btn.update, shell=True) == 0
-                needs_update |= btn.selected ^ old
-            if needs_update:
-                deck = self.deck
-                for key in range(deck.key_count()):
-                    update_key_image(deck, key)
-            time.sleep(0.2)
-
-
-class I3Thread(threading.Thread):
-    def __init__(self, deck):
-        threading.Thread.__init__(self)
-        self.deck = deck
 
-    def run(self):
-        last_json = None
-        while True:
-            needs_update = False
-            workspaces = check_output(['i3-msg', '-t', 'get_workspaces'])
-            if workspaces != last_json:
-                for workspace in json.loads(workspaces):
-                    btn = I3BUTTONS.get(workspace['num'])
-                    if not btn:
-                        continue
-                    old = btn.selected
-                    btn.selected = workspace['visible']
-                    needs_update |= btn.selected ^ old
-                if needs_update:
-                    deck = self.deck
-                    for key in range(deck.key_count()):
-                        update_key_image(deck, key)
-                last_json = workspaces
-            time.sleep(0.2)
-
-
-class VideoThread(threading.Thread):
-    def __init__(self, deck):
-        threading.Thread.__init__(self)
-        self.deck = deck
+VIDEO_WIDTH, VIDEO_HEIGHT = 72, 54
+VIDEO_FRAME_SIZE = VIDEO_WIDTH * VIDEO_HEIGHT * 3
 
-    def run(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.bind(('127.0.0.1', 5555))
-        s.listen(1)
-        conn, addr = s.accept()
-        with conn:
-            while True:
-                image = PILHelper.create_image(deck)
-                frame = conn.recv(11664)
-                if not frame:
-                    break
-                video = Image.frombytes('RGB', (72,54), frame, 'raw')
-                image.paste(video, (0, 0))
-                deck.set_key_image(14, PILHelper.to_native_format(deck, image))
-
-
-
-class RecvThread(threading.Thread):
-    def __init__(self, deck):
-        threading.Thread.__init__(self)
+class VideoServer(object):
+    def __init__(self, sel, deck):
+        self.sel = sel
         self.deck = deck
-
-    def run(self):
-        while True:
-            for row in s.recv(1024).decode('utf-8').strip().split('\n'):
-                data = row.split(' ')
-                if data[0] == 'composite_mode_and_video_status':
-                    for v in SCENE_BUTTONS.values():
-                        v.selected = False
-                    b = SCENE_BUTTONS.get(tuple(data[1:]))
-                    if b is not None:
-                        b.selected = True
-                elif data[0] == 'stream_status':
-                    for v in STREAM_BUTTONS.values():
-                        v.selected = False
-                    b = STREAM_BUTTONS.get((data[-1], data[1] == 'blank'))
-                    if b is not None:
-                        b.selected = True
-                elif data[0] == 'audio_status':
-                    p = json.loads(row[13:])
-                    for b in AUDIO_BUTTONS:
-                        b.selected = p[b.channel] == 1
-                print(repr(data))
-                for key in range(deck.key_count()):
-                    update_key_image(deck, key)
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.server.bind(('127.0.0.1', 5555))
+            self.server.listen(1)
+        except OSError:
+            self.server.close()
+            raise
+        key_image = PILHelper.create_image(deck)
+        # Frames are copied into the top left corner of a key-sized buffer
+        self.canvas = np.zeros((key_image.height, key_image.width, 3), dtype=np.uint8)
+        self.video = self.canvas[:VIDEO_HEIGHT, :VIDEO_WIDTH]
+        self.frame = memoryview(bytearray(VIDEO_FRAME_SIZE))
+        self.frame_pixels = np.frombuffer(self.frame, dtype=np.uint8).reshape(self.video.shape)
+        self.received = 0
+        sel.register(self.server, selectors.EVENT_READ, self.accept)
+
+    # Serves a single video connection, like the listen backlog of one implies
+    def accept(self):
+        self.conn, addr = self.server.accept()
+        self.sel.unregister(self.server)
+        self.server.close()
+        self.sel.register(self.conn, selectors.EVENT_READ, self.readable)
+
+    def readable(self):
+        n = self.conn.recv_into(self.frame[self.received:])
+        if not n:
+            self.sel.unregister(self.conn)
+            self.conn.close()
+            return
+        self.received += n
+        if self.received == VIDEO_FRAME_SIZE:
+            self.received = 0
+            np.copyto(self.video, self.frame_pixels)
+            deck = self.deck
+            deck.set_key_image(14, PILHelper.to_native_format(deck, Image.fromarray(self.canvas)))
+
+
+class VoctomixConnection(object):
+    def __init__(self, sel):
+        self.sel = sel
+        self.buf = bytearray(4096)
+        self.view = memoryview(self.buf)
+        self.pending = bytearray()
+        sel.register(s, selectors.EVENT_READ, self.readable)
+
+    def readable(self):
+        n = s.recv_into(self.buf)
+        if not n:
+            self.sel.unregister(s)
+            return
+        self.pending += self.view[:n]
+        # Keep an incomplete trailing line around until the rest arrives
+        rows_end = self.pending.rfind(b'\n') + 1
+        rows = self.pending[:rows_end].decode('utf-8').split('\n')[:-1]
+        del self.pending[:rows_end]
+        for row in rows:
+            data = tuple(row.split(' '))
+            if data[0] == 'composite_mode_and_video_status':
+                for v in SCENE_BUTTONS.values():
+                    v.selected = False
+                b = SCENE_BUTTONS.get(data[1:])
+                if b is not None:
+                    b.selected = True
+            elif data[0] == 'stream_status':
+                for v in STREAM_BUTTONS.values():
+                    v.selected = False
+                b = STREAM_BUTTONS.get((data[-1], data[1] == 'blank'))
+                if b is not None:
+                    b.selected = True
+            elif data[0] == 'audio_status':
+                for channel, volume in json.loads(row[13:]).items():
+                    index = AUDIO_CHANNELS.get(channel)
+                    if index is not None:
+                        AUDIO_STATE[index] = volume == 1
+            log.debug('%r', data)
+
+
+TICK_INTERVAL = 0.2
+
+# Serves all connections and polls the exec buttons every TICK_INTERVAL from a
+# single thread. Keys are redrawn once per round of events, so bursts of state
+# changes cost a single repaint and only this thread writes to the deck.
+def run(deck):
+    sel = selectors.DefaultSelector()
+    VoctomixConnection(sel)
+    # Workspace tracking and video are optional, the deck works without them
+    if I3BUTTONS:
+        try:
+            I3Connection(sel)
+        except (OSError, CalledProcessError) as e:
+            log.warning("Not following i3 workspaces: %s", e)
+    try:
+        VideoServer(sel, deck)
+    except OSError as e:
+        log.warning("Not receiving video: %s", e)
+
+    key_images = render_all_key_images(deck)
+    shown = [None] * len(BUTTONS)
+    next_tick = time.monotonic()
+    while True:
+        # A failing handler or check must not stop the only thread serving
+        # the deck, so errors are logged and the loop carries on
+        for key, _ in sel.select(max(0, next_tick - time.monotonic())):
+            try:
+                key.data()
+            except Exception:
+                log.exception("Error handling %r", key.fileobj)
+        if time.monotonic() >= next_tick:
+            for btn in UPDATE_BUTTONS:
+                try:
+                    btn.selected = btn.update()
+                except Exception:
+                    log.exception("Error updating %r", btn.label)
+            next_tick = time.monotonic() + TICK_INTERVAL
+        repaint_changed_keys(deck, key_images, shown)
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     streamdecks = DeviceManager().enumerate()
 
     print("Found {} Stream Deck(s).\n".format(len(streamdecks)))
@@ -276,22 +473,8 @@ if __name__ == "__main__":
         # Set initial screen brightness to 30%
         deck.set_brightness(30)
 
-        # Set initial key images
-        for key in range(deck.key_count()):
-            update_key_image(deck, key)
-
         # Register callback function for when a key state changes
         deck.set_key_callback(key_change_callback)
-        RecvThread(deck).start()
-        TickThread(deck).start()
-        I3Thread(deck).start()
-        VideoThread(deck).start()
-
-        # Wait until all application threads have terminated (for this example,
-        # this is when all deck handles are closed)
-        for t in threading.enumerate():
-            if t is threading.currentThread():
-                continue
-
-            if t.is_alive():
-                t.join()
+
+        # Set initial key images and serve events until interrupted
+        run(deck)